@@ -1,8 +1,18 @@
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class MoexClient:
@@ -10,31 +20,88 @@ class MoexClient:
     DEFAULT_ENGINE = "stock"
     DEFAULT_MARKET = "shares"
     DEFAULT_BOARD = "TQBR"
-
-    __slots__ = ("ticker", "engine", "market", "board")
+    MAX_WORKERS = 8
+    MAX_RPS = 8
+    PAGE_LIMITS = {"history": 1000, "candles": 500}
+    PLOT_POINTS = 4000
+    REFERENCE_TTL = 3600
+    INTERVALS = {"1m": 1, "10m": 10, "1h": 60, "1d": 1440}
+    HISTORY_COLUMNS = {"history": ("TRADEDATE", "CLOSE", "VOLUME"), "candles": ("end", "close", "volume")}
+    TIMESTAMP_FORMATS = {"history": "%Y-%m-%d", "candles": "%Y-%m-%d %H:%M:%S"}
+
+    __slots__ = ("ticker", "engine", "market", "board", "session")
+
+    _cache: Dict = {}
+    _cache_lock = threading.Lock()
+    _throttle_lock = threading.Lock()
+    _next_request_at = 0.0
 
     def __init__(self, ticker: str, engine: str = DEFAULT_ENGINE, market: str = DEFAULT_MARKET, board: str = DEFAULT_BOARD):
         self.ticker = ticker.upper()
         self.engine = engine
         self.market = market
         self.board = board
-
-    def _get(self, endpoint: str, params: Optional[Dict] = None) -> Dict:
+        self.session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], respect_retry_after_header=True)
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+
+    def _throttle(self) -> None:
+        with MoexClient._throttle_lock:
+            now = time.monotonic()
+            wait = MoexClient._next_request_at - now
+            MoexClient._next_request_at = max(now, MoexClient._next_request_at) + 1 / self.MAX_RPS
+        if wait > 0:
+            time.sleep(wait)
+
+    def _get(self, endpoint: str, params: Optional[Dict] = None, ttl: Optional[float] = None) -> Dict:
         url = f"{self.BASE_URL}/{endpoint}"
+        key = (url, frozenset((params or {}).items()))
+        if ttl:
+            with self._cache_lock:
+                cached = self._cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                return cached[1]
         try:
-            resp = requests.get(url, params=params, timeout=5)
+            self._throttle()
+            resp = self.session.get(url, params=params, timeout=5)
             resp.raise_for_status()
-            data = resp.json()
+            data = orjson.loads(resp.content) if orjson else resp.json()
             if not data:
                 raise RuntimeError(f"Empty response from MOEX API: {url}")
+            if ttl:
+                with self._cache_lock:
+                    self._cache[key] = (time.monotonic() + ttl, data)
             return data
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, ValueError) as e:
             raise RuntimeError(f"Error during MOEX request {url}: {e}") from e
-        
+
+    def _get_pages(self, endpoint: str, params: Dict, limit: int) -> Iterator[Dict]:
+        page = self._get(endpoint, {**params, "start": 0, "limit": limit})
+        yield page
+        block = page.get("history") or page.get("candles") or {}
+        step = len(block.get("data", []))
+        if not step:
+            return
+
+        cursor = page.get("history.cursor", {})
+        if cursor.get("data"):
+            info = dict(zip(cursor["columns"], cursor["data"][0]))
+            offsets = range(step, info["TOTAL"], step)
+            with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as pool:
+                yield from pool.map(lambda offset: self._get(endpoint, {**params, "start": offset, "limit": limit}), offsets)
+            return
+
+        start_index = 0
+        while len(block.get("data", [])) >= limit:
+            start_index += limit
+            page = self._get(endpoint, {**params, "start": start_index, "limit": limit})
+            yield page
+            block = page.get("history") or page.get("candles") or {}
+
     def get_markets(self, engine: str = None) -> pd.DataFrame:
         engine = engine or self.engine
         endpoint = f"engines/{engine}/markets.json"
-        j = self._get(endpoint)
+        j = self._get(endpoint, ttl=self.REFERENCE_TTL)
         data = j.get("markets", {}).get("data", [])
         cols = j.get("markets", {}).get("columns", [])
         if not data:
@@ -43,90 +110,108 @@ class MoexClient:
 
     def get_engines(self) -> pd.DataFrame:
         endpoint = "engines.json"
-        j = self._get(endpoint)
+        j = self._get(endpoint, ttl=self.REFERENCE_TTL)
         data = j.get("engines", {}).get("data", [])
         cols = j.get("engines", {}).get("columns", [])
         if not data:
             raise ValueError("No engines found on MOEX")
         return pd.DataFrame(data, columns=cols)
 
-    def get_securities(self, market: str = "shares") -> pd.DataFrame:
+    def get_securities(self, market: str = "shares", tickers: Optional[List[str]] = None) -> pd.DataFrame:
         endpoint = f"engines/{self.engine}/markets/{market}/securities.json"
-        j = self._get(endpoint)
+        params = {"securities": ",".join(t.upper() for t in tickers)} if tickers else None
+        j = self._get(endpoint, params, ttl=self.REFERENCE_TTL)
         data = j.get("securities", {}).get("data", [])
         cols = j.get("securities", {}).get("columns", [])
         return pd.DataFrame(data, columns=cols)
 
     def get_history(self, start: str, end: str, interval: str = "1d") -> pd.DataFrame:
-        intervals = {"1m": 1, "10m": 10, "1h": 60, "1d": 1440}
-        if interval not in intervals:
-            raise ValueError(f"Invalid interval {interval}, choose from {list(intervals.keys())}")
+        if interval not in self.INTERVALS:
+            raise ValueError(f"Invalid interval {interval}, choose from {list(self.INTERVALS)}")
 
         if interval == "1d":
             endpoint = f"history/engines/{self.engine}/markets/{self.market}/boards/{self.board}/securities/{self.ticker}.json"
-            params = {"from": start, "till": end}
+            block_name = "history"
+            params = {"from": start, "till": end, "iss.only": "history,history.cursor"}
         else:
             endpoint = f"engines/{self.engine}/markets/{self.market}/securities/{self.ticker}/candles.json"
-            params = {"from": start, "till": end, "interval": intervals[interval]}
-
-        all_dfs = []
-        start_index = 0
-        limit = 100
-
-        while True:
-            params["start"] = start_index
-            params["limit"] = limit
-            j = self._get(endpoint, params)
-            block = j.get("history") or j.get("candles")
+            block_name = "candles"
+            params = {"from": start, "till": end, "interval": self.INTERVALS[interval], "iss.only": "candles"}
+        params["iss.meta"] = "off"
+        params[f"{block_name}.columns"] = ",".join(self.HISTORY_COLUMNS[block_name])
+
+        dates, closes, volumes = [], [], []
+        seen = set()
+        date_idx = close_idx = volume_idx = None
+        for j in self._get_pages(endpoint, params, limit=self.PAGE_LIMITS[block_name]):
+            block = j.get(block_name)
             if not block:
                 break
 
             data, cols = block.get("data", []), block.get("columns", [])
             if not data:
                 break
-            df = pd.DataFrame(data, columns=cols)
-            if "end" in df:
-                df["TRADEDATE"] = pd.to_datetime(df["end"])
-                df.rename(columns={"close": "CLOSE"}, inplace=True)
-            else:
-                df["TRADEDATE"] = pd.to_datetime(df["TRADEDATE"])
-
-            if "CLOSE" not in df:
-                break
-
-            volume_col = "VOLUME" if "VOLUME" in df else None
-            if volume_col:
-                all_dfs.append(df[["TRADEDATE", "CLOSE", volume_col]])
-            else:
-                all_dfs.append(df[["TRADEDATE", "CLOSE"]])
-
-            if len(df) < limit:
-                break
-            start_index += limit
-
-        if not all_dfs:
+            if date_idx is None:
+                date_col, close_col, volume_col = self.HISTORY_COLUMNS[block_name]
+                if close_col not in cols:
+                    break
+                date_idx, close_idx = cols.index(date_col), cols.index(close_col)
+                volume_idx = cols.index(volume_col) if volume_col in cols else None
+
+            page_closes, page_volumes = [], []
+            for row in data:
+                date = row[date_idx]
+                if date in seen:
+                    continue
+                seen.add(date)
+                dates.append(date)
+                page_closes.append(row[close_idx])
+                page_volumes.append(row[volume_idx] if volume_idx is not None else None)
+            closes.append(np.asarray(page_closes, dtype=np.float32))
+            volumes.append(np.asarray(page_volumes, dtype=np.float64))
+
+        if not dates:
             raise ValueError(f"No data for {self.ticker} for period {start} — {end}")
 
-        df = pd.concat(all_dfs, ignore_index=True)
-        df.drop_duplicates(subset="TRADEDATE", inplace=True)
-        df.sort_values("TRADEDATE", inplace=True)
-        df.reset_index(drop=True, inplace=True)
-        df.rename(columns={"TRADEDATE": "TIMESTAMP", "CLOSE": "PRICE"}, inplace=True)
-        df.rename(columns={"volume": "VOLUME"}, inplace=True)
-        df["LOGRET"] = np.log(df["PRICE"] / df["PRICE"].shift(1))
-        df["RET"] = df["PRICE"].pct_change()
-        df["CUMRET"] = (1 + df["RET"]).cumprod()
+        prices = np.concatenate(closes)
+        ratio = np.empty_like(prices)
+        ratio[0] = np.nan
+        np.divide(prices[1:], prices[:-1], out=ratio[1:])
+        first = np.argmax(np.isfinite(prices))
+        cumret = prices.astype(np.float64) / prices[first]
+        cumret[:first + 1] = np.nan
+        df = pd.DataFrame({
+            "TIMESTAMP": pd.to_datetime(dates, format=self.TIMESTAMP_FORMATS[block_name], cache=True),
+            "PRICE": prices,
+            "VOLUME": np.concatenate(volumes),
+            "LOGRET": np.log(ratio),
+            "RET": ratio - 1.0,
+            "CUMRET": cumret,
+        }, copy=False)
         print(f"Fetch {len(df)} lines {self.ticker} ({interval}): {start} -> {end}")
         return df
     
     def plot(self, history: pd.DataFrame):
         fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 8), gridspec_kw={'height_ratios': [3, 1]}, sharex=True)
-        ax1.plot(history.index, history['PRICE'], color='black', linewidth=1.5, label='Цена')
+        x, price, volume = history.index.to_numpy(), history['PRICE'].to_numpy(), history['VOLUME'].to_numpy()
+        downsampled = len(history) > self.PLOT_POINTS
+        if downsampled:
+            edges = np.linspace(0, len(history), self.PLOT_POINTS, endpoint=False).astype(np.intp)
+            last = np.append(edges[1:], len(history)) - 1
+            bins = np.stack([price[edges], np.fmin.reduceat(price, edges), np.fmax.reduceat(price, edges), price[last]], axis=1)
+            volume = np.add.reduceat(np.nan_to_num(volume), edges)
+            x, x_price, price = np.append(x[edges], x[-1]), np.repeat(x[edges], 4), bins.ravel()
+        else:
+            x_price = x
+        ax1.plot(x_price, price, color='black', linewidth=1.5, label='Цена')
         ax1.set_ylabel('Цена', fontsize=12)
         ax1.grid(True, alpha=0.3)
         ax1.legend()
 
-        ax2.bar(history.index, history['VOLUME'], color='blue', alpha=0.7, label='Объем')
+        if downsampled:
+            ax2.fill_between(x, np.append(volume, volume[-1]), step='post', color='blue', alpha=0.7, label='Объем')
+        else:
+            ax2.bar(x, volume, color='blue', alpha=0.7, label='Объем')
         ax2.set_ylabel('Объем', fontsize=12)
         ax2.grid(True, alpha=0.3)
         ax2.legend()